@@ -6,7 +6,10 @@ PROJECT_DIR = os.path.dirname(os.path.abspath(__file__))
 BASE_DATA_DIR = os.path.join(PROJECT_DIR, "../memes_data/hateful_memes/")
 JSONL_FILE = "dev_seen.jsonl"
 IMG_DIR = "img/"
-OFFLINE_FILE = os.path.join(PROJECT_DIR, "historical_tags.csv")
+# Offline store is a Parquet dataset directory; each write_offline() adds one part file
+OFFLINE_FILE = os.path.join(PROJECT_DIR, "historical_tags.parquet")
+# Fitted ranker, reused on start-up while it is newer than OFFLINE_FILE
+MODEL_FILE = os.path.join(PROJECT_DIR, "ranker_model.joblib")
 
 # Model Configs
 POLICY_THRESHOLDS = {
@@ -18,8 +21,30 @@ POLICY_THRESHOLDS = {
 
 # Network Local VLM (Ollama)
 OLLAMA_URL = "http://192.168.2.16:11434/api/generate"
+# Add more hosts to spread a batch across several Ollama servers (least-loaded dispatch)
+OLLAMA_URLS = [OLLAMA_URL]
 OLLAMA_MODEL = "llama3.2-vision:11b"
 OLLAMA_TEXT_MODEL = "llama3:8b"
+# Max in-flight requests per endpoint. Keep in line with the server's OLLAMA_NUM_PARALLEL env var;
+# setting both >= batch size lets Ollama merge a whole phase of prompts into one forward pass.
+OLLAMA_NUM_PARALLEL = 4
+# Per-request timeout (s) and extra attempts; retries go to the least-loaded healthy endpoint
+OLLAMA_TIMEOUT = 30
+OLLAMA_RETRIES = 2
+# Circuit breaker: this many failures on one endpoint within the window (s) skips it for the cooldown (s)
+OLLAMA_BREAKER_FAILURES = 3
+OLLAMA_BREAKER_WINDOW = 60
+OLLAMA_BREAKER_COOLDOWN = 30
+# Gzip request bodies. Ollama itself does not decode compressed requests, so only enable
+# this behind a proxy that does. Responses are always accepted gzip-encoded.
+OLLAMA_GZIP_REQUESTS = False
+# Images are downscaled (longest side) and re-encoded as JPEG before upload;
+# vision models resize to ~336-448 px internally anyway
+VLM_MAX_IMAGE_SIDE = 512
+VLM_JPEG_QUALITY = 85
 PROMPT_FILE = "prompt.txt"
 LLM_PROMPT_FILE = "llm_prompt.txt"
-test = "dev_unseen.jsonl"
\ No newline at end of file
+test = "dev_unseen.jsonl"
+
+# verify_data_integrity: last scan of the dataset tree, reused while no directory changes
+FS_INDEX_CACHE = os.path.expanduser("~/.cache/harmful_meme/fs_index.pkl")
\ No newline at end of file
@@ -1,14 +1,116 @@
 import os
 import json
+import asyncio
+import collections
+import time
+import numpy as np
 import pandas as pd
-import random
-import base64
-import requests
-from typing import List, Dict
+import functools
+import gzip
+import io
+import itertools
+import string
+import httpx
+import orjson
+import pybase64
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Callable, List, Dict
 from PIL import Image
 import config
 
 
+# Every key the VLM is asked for, with the value used when the model omits it
+_VLM_SCHEMA = {
+    "visual_summary": "Summary not found",
+    "ocr_text": "",
+    "is_sarcastic": False,
+    "is_sarcastic_reason": "",
+    "is_harmful": False,
+    "is_harmful_reason": "",
+    "is_offensive": False,
+    "is_offensive_reason": "",
+    "is_violent": False,
+    "is_violent_reason": "",
+    "is_sexual": False,
+    "is_sexual_reason": "",
+    "is_explicit": False,
+    "is_explicit_reason": "",
+    "is_terrorist": False,
+    "is_terrorist_reason": "",
+    "is_extremist": False,
+    "is_extremist_reason": "",
+    "is_child_exploitation": False,
+    "is_child_exploitation_reason": "",
+    "is_hate_speech": False,
+    "is_hate_speech_reason": "",
+    "is_spam": False,
+    "is_spam_reason": "",
+    "is_racist_or_racial_slur": False,
+    "is_racist_or_racial_slur_reason": "",
+}
+
+# Record used when the VLM call itself fails
+_VLM_ERROR_OUTPUT = {k: ("ERROR" if isinstance(v, str) else v) for k, v in _VLM_SCHEMA.items()}
+
+
+@functools.lru_cache(maxsize=8)
+def _load_prompt(filename: str) -> str:
+    """Loads the base prompt from the external file (cached per filename)."""
+    # Attempt relative to cwd/execution point first, then fallback
+    candidates = [
+        filename, 
+        os.path.join(os.path.dirname(__file__), filename)
+    ]
+    
+    for p in candidates:
+        if os.path.exists(p):
+            print(f"Loading external prompt from: {p}")
+            with open(p, 'r') as f:
+                return f.read().strip()
+    
+    print(f"Warning: {filename} not found. Using default.")
+    return """
+    Analyze this image for a content moderation system.
+    1. Provide a concise visual summary (what is happening?).
+    2. Extract ALL text visible in the image exactly as written (OCR).
+    3. Make sure to mention if the post is sarcastic or not.
+    4. if it is sarcastic, then provide a reason for it and specify if this is harmful content or not.
+    """
+
+
+def _compile_prompt(template: str, fields: List[str]) -> Callable[..., str]:
+    """
+    Turns a str.format template into an f-string lambda so the template is parsed
+    once rather than on every call. Templates using format specs or conversions
+    keep plain str.format.
+    """
+    source = []
+    for literal, name, spec, conversion in string.Formatter().parse(template):
+        source.append(literal.replace("{", "{{").replace("}", "}}"))
+        if name is None:
+            continue
+        if name not in fields or spec or conversion:
+            return lambda **kwargs: template.format(**kwargs)
+        source.append("{" + name + "}")
+    # Safe to eval: literals go through repr() and every field is a known identifier
+    return eval(f"lambda {', '.join(fields)}: f{''.join(source)!r}")
+
+
+@functools.lru_cache(maxsize=256)
+def _encode_image_cached(image_path: str, mtime: float) -> str:
+    """
+    Base64 of an image file, downscaled to what the VLM actually looks at and
+    re-encoded as JPEG. mtime is part of the key so edited files are re-read.
+    """
+    max_side = (config.VLM_MAX_IMAGE_SIDE, config.VLM_MAX_IMAGE_SIDE)
+    with Image.open(image_path) as img:
+        img.draft('RGB', max_side)  # Lets JPEG decode at reduced scale; no-op for other formats
+        img.thumbnail(max_side)
+        buf = io.BytesIO()
+        img.convert('RGB').save(buf, 'JPEG', quality=config.VLM_JPEG_QUALITY)
+    return pybase64.b64encode(buf.getvalue()).decode('ascii')
+
+
 class FeatureFactory:
     """
     Stage 1: The Granular Feature Factory.
@@ -23,37 +125,44 @@ class FeatureFactory:
         
 
         # Load Prompts
-        self.base_prompt = self._load_prompt(config.PROMPT_FILE)
-        self.llm_prompt = self._load_prompt(config.LLM_PROMPT_FILE)
-
-    def _load_prompt(self, filename: str) -> str:
-        """Loads the base prompt from the external file."""
-        prompt_path = os.path.join(self.data_dir, "../../../", filename) 
-        # Attempt relative to cwd/execution point first, then fallback
-        candidates = [
-            filename, 
-            os.path.join(os.path.dirname(__file__), filename)
-        ]
-        
-        for p in candidates:
-            if os.path.exists(p):
-                print(f"Loading external prompt from: {p}")
-                with open(p, 'r') as f:
-                    return f.read().strip()
-        
-        print(f"Warning: {filename} not found. Using default.")
-        return """
-        Analyze this image for a content moderation system.
-        1. Provide a concise visual summary (what is happening?).
-        2. Extract ALL text visible in the image exactly as written (OCR).
-        3. Make sure to mention if the post is sarcastic or not.
-        4. if it is sarcastic, then provide a reason for it and specify if this is harmful content or not.
-        """
+        self.base_prompt = _load_prompt(config.PROMPT_FILE)
+        self.llm_prompt = _load_prompt(config.LLM_PROMPT_FILE)
+        self._llm_prompt_fn = _compile_prompt(self.llm_prompt, ["post_text", "visual_summary", "ocr_text"])
+
+        # One pooled keep-alive client per Ollama endpoint (and the loop they are bound to)
+        # reused across batches, so each call does not pay a fresh TCP handshake.
+        self._loop = asyncio.new_event_loop()
+        self.clients = {
+            url: httpx.AsyncClient(
+                limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+                headers={"Connection": "keep-alive", "Accept-Encoding": "gzip, deflate"},
+            )
+            for url in config.OLLAMA_URLS
+        }
+        # Concurrency cap per endpoint, matching each server's OLLAMA_NUM_PARALLEL.
+        # Semaphores bind to a loop on first use, not at construction (Python 3.10+).
+        self._semaphores = {
+            url: asyncio.Semaphore(config.OLLAMA_NUM_PARALLEL) for url in config.OLLAMA_URLS
+        }
+        # Requests dispatched to each endpoint and not yet answered (queued or running)
+        self._inflight = {url: 0 for url in config.OLLAMA_URLS}
+        self._rr = itertools.count()
+        # Circuit breaker state: recent failure times, and when each open breaker closes again
+        self._failures = {url: collections.deque() for url in config.OLLAMA_URLS}
+        self._open_until = {url: 0.0 for url in config.OLLAMA_URLS}
+        # Image reads + base64 release the GIL, so a batch encodes in parallel.
+        self._executor = ThreadPoolExecutor(max_workers=8)
 
+    def close(self):
+        """Releases pooled Ollama connections and encoder threads. Call once on shutdown."""
+        for client in self.clients.values():
+            self._loop.run_until_complete(client.aclose())
+        self._loop.close()
+        self._executor.shutdown()
 
     def ingest_data(self, limit: int = None, override_file: str = None) -> pd.DataFrame:
         """Step 1: Ingest & Encode."""
-        data = []
+        entries = []
         
         # Determine strict target file
         if override_file:
@@ -67,37 +176,124 @@ class FeatureFactory:
 
         print(f"Reading data from {target_file}...")
         try:
-            with open(target_file, 'r') as f:
+            # Binary mode: orjson parses bytes directly, skipping the text decode step
+            with open(target_file, 'rb') as f:
                 for idx, line in enumerate(f):
                     if limit and idx >= limit:
                         break
-                    entry = json.loads(line)
-                    abs_path = os.path.join(self.data_dir, entry['img'])
-                    
-                    if os.path.exists(abs_path):
-                        entry['img_abs_path'] = abs_path
-                        data.append(entry)
-                    else:
-                         # Skip missing images so we don't crash later
-                         pass
+                    entry = orjson.loads(line)
+                    entry['img_abs_path'] = os.path.join(self.data_dir, entry['img'])
+                    entries.append(entry)
         except FileNotFoundError:
              print(f"Error: File not found at {target_file}")
              return pd.DataFrame()
 
+        # Skip missing images so we don't crash later
+        data = [entry for entry, exists in zip(entries, self._images_exist(entries)) if exists]
+
         df = pd.DataFrame(data)
         print(f"Ingested {len(df)} posts.")
         return df
 
+    def _images_exist(self, entries: List[Dict]) -> List[bool]:
+        """
+        Checks which entries have their image on disk. Images under IMG_DIR are
+        matched against a single scandir listing; anything elsewhere falls back
+        to os.path.exists on the thread pool.
+        """
+        img_subdir = os.path.normpath(config.IMG_DIR)
+        try:
+            with os.scandir(self.img_dir) as it:
+                existing = {e.name for e in it if e.is_file()}
+        except OSError:
+            # Missing, unreadable or not a directory: like os.path.exists, treat as no images
+            existing = set()
+
+        found = []
+        elsewhere = []
+        for idx, entry in enumerate(entries):
+            subdir, name = os.path.split(entry['img'])
+            if os.path.normpath(subdir) == img_subdir:
+                found.append(name in existing)
+            else:
+                found.append(False)
+                elsewhere.append(idx)
+
+        paths = [entries[idx]['img_abs_path'] for idx in elsewhere]
+        for idx, exists in zip(elsewhere, self._executor.map(os.path.exists, paths)):
+            found[idx] = exists
+        return found
+
     def _encode_image(self, image_path: str) -> str:
         """Helper to encode image to base64 for API transmission."""
-        with open(image_path, "rb") as image_file:
-            return base64.b64encode(image_file.read()).decode('utf-8')
+        return _encode_image_cached(image_path, os.path.getmtime(image_path))
+
+
+    def _pick_endpoint(self) -> str:
+        """
+        Least-loaded Ollama endpoint; ties are broken round-robin. Endpoints with
+        an open circuit breaker are skipped; if every endpoint is open the call
+        fails fast instead of waiting out another timeout.
+        """
+        now = time.monotonic()
+        urls = [url for url in config.OLLAMA_URLS if self._open_until[url] <= now]
+        if not urls:
+            raise RuntimeError("All Ollama circuits are open")
+        start = next(self._rr) % len(urls)
+        return min(urls[start:] + urls[:start], key=self._inflight.__getitem__)
+
+    def _record_failure(self, url: str):
+        """Opens the endpoint's breaker after too many failures inside the sliding window."""
+        now = time.monotonic()
+        failures = self._failures[url]
+        failures.append(now)
+        while now - failures[0] > config.OLLAMA_BREAKER_WINDOW:
+            failures.popleft()
+        if len(failures) >= config.OLLAMA_BREAKER_FAILURES:
+            failures.clear()
+            self._open_until[url] = now + config.OLLAMA_BREAKER_COOLDOWN
+            print(f"Circuit open for {url}; skipping it for {config.OLLAMA_BREAKER_COOLDOWN}s")
+
+    async def _post(self, payload: Dict) -> Dict:
+        """POSTs a generate request to an Ollama endpoint, throttled by its batch semaphore."""
+        body = orjson.dumps(payload)
+        headers = {"Content-Type": "application/json"}
+        if config.OLLAMA_GZIP_REQUESTS:
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
 
+        attempt = 0
+        while True:
+            # Raises once every endpoint's circuit is open
+            url = self._pick_endpoint()
+            self._inflight[url] += 1
+            try:
+                async with self._semaphores[url]:
+                    # The breaker may have opened while this call was queued for a slot;
+                    # re-pick a healthy endpoint without spending an attempt or a backoff
+                    if self._open_until[url] > time.monotonic():
+                        continue
+                    response = await self.clients[url].post(
+                        url, content=body, headers=headers, timeout=config.OLLAMA_TIMEOUT
+                    )
+                response.raise_for_status()
+                self._failures[url].clear()
+                return response.json()
+            except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                # Timeouts, connection errors and 5xx count against the endpoint; 4xx are our fault
+                if isinstance(e, httpx.HTTPStatusError) and e.response.status_code < 500:
+                    raise
+                self._record_failure(url)
+                if attempt == config.OLLAMA_RETRIES:
+                    raise
+                print(f"Ollama call to {url} failed ({e!r}); retrying...")
+            finally:
+                self._inflight[url] -= 1
+            await asyncio.sleep(0.5 * 2 ** attempt)
+            attempt += 1
 
-    def _call_vlm(self, image_path: str) -> Dict[str, str]:
+    async def _call_vlm(self, base64_image: str) -> Dict[str, str]:
         """Network Local VLM implementation using Ollama API."""
-        base64_image = self._encode_image(image_path)
-        
         payload = {
             "model": config.OLLAMA_MODEL,
             "prompt": self.base_prompt,
@@ -106,87 +302,36 @@ class FeatureFactory:
             "format": "json" # Force JSON output
         }
 
-        print(f"Calling Ollama ({config.OLLAMA_URL})...")
-        response = requests.post(config.OLLAMA_URL, json=payload, timeout=30)
-        response.raise_for_status()
-        
-        result = response.json()
+        print("Calling Ollama (VLM)...")
+        result = await self._post(payload)
         response_payload = result.get('response', '{}')
         
         # Parse JSON from Ollama response
         try:
             parsed = json.loads(response_payload)
-            return {
-                "visual_summary": parsed.get("visual_summary", "Summary not found"),
-                "ocr_text": parsed.get("ocr_text", ""),
-                "is_sarcastic": parsed.get("is_sarcastic", False),
-                "is_sarcastic_reason": parsed.get("is_sarcastic_reason", ""),
-                "is_harmful": parsed.get("is_harmful", False),
-                "is_harmful_reason": parsed.get("is_harmful_reason", ""),
-                "is_offensive": parsed.get("is_offensive", False),
-                "is_offensive_reason": parsed.get("is_offensive_reason", ""),
-                "is_violent": parsed.get("is_violent", False),
-                "is_violent_reason": parsed.get("is_violent_reason", ""),
-                "is_sexual": parsed.get("is_sexual", False),
-                "is_sexual_reason": parsed.get("is_sexual_reason", ""),
-                "is_explicit": parsed.get("is_explicit", False),
-                "is_explicit_reason": parsed.get("is_explicit_reason", ""),
-                "is_terrorist": parsed.get("is_terrorist", False),
-                "is_terrorist_reason": parsed.get("is_terrorist_reason", ""),
-                "is_extremist": parsed.get("is_extremist", False),
-                "is_extremist_reason": parsed.get("is_extremist_reason", ""),
-                "is_child_exploitation": parsed.get("is_child_exploitation", False),
-                "is_child_exploitation_reason": parsed.get("is_child_exploitation_reason", ""),
-                "is_hate_speech": parsed.get("is_hate_speech", False),
-                "is_hate_speech_reason": parsed.get("is_hate_speech_reason", ""),
-                "is_spam": parsed.get("is_spam", False),
-                "is_spam_reason": parsed.get("is_spam_reason", ""),
-                "is_racist_or_racial_slur": parsed.get("is_racist_or_racial_slur", False),
-                "is_racist_or_racial_slur_reason": parsed.get("is_racist_or_racial_slur_reason", ""),
-            }
+            return {**_VLM_SCHEMA, **{k: parsed[k] for k in parsed if k in _VLM_SCHEMA}}
         except json.JSONDecodeError:
             # Fallback if model didn't return strict JSON
             return {
-                "visual_summary": response_text[:200], # Truncate raw text
+                **_VLM_SCHEMA,
+                "visual_summary": response_payload[:200], # Truncate raw text
                 "ocr_text": "[Raw Output: JSON Parse Failed]",
-                "is_sarcastic": False,
-                "is_sarcastic_reason": "",  
-                "is_harmful": False,
-                "is_harmful_reason": "", 
-                "is_offensive": False,
-                "is_offensive_reason": "", 
-                "is_violent": False,
-                "is_violent_reason": "", 
-                "is_sexual": False,
-                "is_sexual_reason": "", 
-                "is_terrorist": False,
-                "is_terrorist_reason": "", 
-                "is_extremist": False,
-                "is_extremist_reason": "", 
-                "is_child_exploitation": False,
-                "is_child_exploitation_reason": "", 
-                "is_hate_speech": False,
-                "is_hate_speech_reason": "", 
-                "is_spam": False,
-                "is_spam_reason": "", 
-                "is_racist_or_racial_slur": False,
-                "is_racist_or_racial_slur_reason": "",
             }
 
-    def generate_caption(self, image_path: str) -> Dict[str, str]:
+    async def generate_caption(self, base64_image: str) -> Dict[str, str]:
         """
         Step 2: VLM Analysis (Visual + OCR).
         """
-        return self._call_vlm(image_path)
+        return await self._call_vlm(base64_image)
 
 
-    def summarize_text(self, post_text: str, vlm_output: Dict[str, str]) -> List[str]:
+    async def summarize_text(self, post_text: str, vlm_output: Dict[str, str]) -> List[str]:
         """Step 3: Text Transformer (using Ollama)."""
         summary = vlm_output.get("visual_summary", "")
         ocr_text = vlm_output.get("ocr_text", "")
         
         # Format the prompt
-        prompt = self.llm_prompt.format(
+        prompt = self._llm_prompt_fn(
             post_text=post_text,
             visual_summary=summary,
             ocr_text=ocr_text
@@ -200,9 +345,7 @@ class FeatureFactory:
 
         print(f"Calling Ollama (Text) for summary...")
         try:
-             response = requests.post(config.OLLAMA_URL, json=payload, timeout=30)
-             response.raise_for_status()
-             result = response.json()
+             result = await self._post(payload)
              response_text = result.get('response', '')
              
              # Clean up the response to get a list
@@ -215,91 +358,80 @@ class FeatureFactory:
             combined_context = f"Post Text: {post_text}. Image shows: {summary}. Image text says: {ocr_text}"
             return list(set([w.lower() for w in combined_context.split() if len(w) > 3]))
 
-    def classify_to_scores(self, keywords: List[str]) -> Dict[str, float]:
-        """Step 4: Tag Generation."""
+    def classify_to_scores(self, keywords_list: List[List[str]]) -> pd.DataFrame:
+        """Step 4: Tag Generation (vectorized over the whole batch)."""
         triggers = ["hate", "kill", "attack", "stupid"]
-        base_score = random.random() * 0.5 
-        if any(t in keywords for t in triggers):
-            base_score += 0.4
-        scores = {
-            "Harmful_Content": min(1.0, base_score + random.uniform(-0.1, 0.1)),
-            "Political_Content": random.random(),
-            "Spam": random.random() * 0.3,
-            "Copyright_Infringement": random.random() * 0.1
-        }
+        n = len(keywords_list)
+        trigger_hit = np.array([any(t in kw for t in triggers) for kw in keywords_list], dtype=bool)
+        base_score = np.random.random(n) * 0.5 + trigger_hit * 0.4
+        scores = pd.DataFrame({
+            "Harmful_Content": np.minimum(1.0, base_score + np.random.uniform(-0.1, 0.1, n)),
+            "Political_Content": np.random.random(n),
+            "Spam": np.random.random(n) * 0.3,
+            "Copyright_Infringement": np.random.random(n) * 0.1
+        })
         return scores
 
-    def apply_policy(self, scores: Dict[str, float]) -> Dict[str, int]:
+    def apply_policy(self, scores: pd.DataFrame) -> pd.DataFrame:
         """Step 5: Policy Threshold."""
-        tags = {}
-        for category, score in scores.items():
-            threshold = self.policy_thresholds.get(category, 0.5)
-            tags[f"Is_{category}"] = 1 if score >= threshold else 0
-        return tags
+        thresholds = np.array([self.policy_thresholds.get(c, 0.5) for c in scores.columns])
+        tags = (scores.to_numpy() >= thresholds).astype(np.int8)
+        return pd.DataFrame(tags, columns=[f"Is_{c}" for c in scores.columns])
+
+    async def _caption_or_error(self, img_path: str, encoded: Future) -> Dict[str, str]:
+        """VLM Analysis that degrades to an ERROR record instead of failing the batch."""
+        try:
+            base64_image = await asyncio.wrap_future(encoded)
+            # use_ollama is default True now
+            return await self.generate_caption(base64_image)
+        except Exception as e:
+            print(f"Error processing image {img_path}: {e}")
+            return dict(_VLM_ERROR_OUTPUT)
+
+    async def _process_batch_async(self, texts: List[str], img_paths: List[str]):
+        """
+        Two phases, each fanned out concurrently: all VLM calls first, then all
+        text prompts together so they land in the same Ollama batching window.
+        Concurrency is capped per endpoint to match each server's OLLAMA_NUM_PARALLEL.
+        """
+        # Encode all images up front on the thread pool
+        encoded = [self._executor.submit(self._encode_image, img_path) for img_path in img_paths]
+
+        # 1. VLM Analysis
+        vlm_outputs = await asyncio.gather(*[
+            self._caption_or_error(img_path, future)
+            for img_path, future in zip(img_paths, encoded)
+        ])
+        print(f"VLM analysis done for {len(img_paths)} posts.")
+
+        # 2. Text Transformer
+        keywords_list = await asyncio.gather(*[
+            self.summarize_text(post_text, vlm_output)
+            for post_text, vlm_output in zip(texts, vlm_outputs)
+        ])
+        print(f"Text summaries done for {len(texts)} posts.")
+        return vlm_outputs, keywords_list
 
     def process_batch(self, df: pd.DataFrame) -> pd.DataFrame:
-        results = []
         print("\n--- Processing Batch (Stage 1) ---")
-        for i, row in df.iterrows():
-            post_id = row['id']
-            post_text = row.get('text', '')
-            img_path = row['img_abs_path']
-            
-            # 1. VLM Analysis
-            try:
-                # use_ollama is default True now
-                vlm_output = self.generate_caption(img_path)
-            except Exception as e:
-                print(f"Error processing image {img_path}: {e}")
-                vlm_output = {
-                    "visual_summary": "ERROR", 
-                    "ocr_text": "ERROR",
-                    "is_sarcastic": False,
-                    "is_sarcastic_reason": "ERROR",
-                    "is_harmful": False,
-                    "is_harmful_reason": "ERROR",
-                    "is_offensive": False,
-                    "is_offensive_reason": "ERROR",
-                    "is_violent": False,
-                    "is_violent_reason": "ERROR",
-                    "is_sexual": False,
-                    "is_sexual_reason": "ERROR",
-                    "is_explicit": False,
-                    "is_explicit_reason": "ERROR",
-                    "is_terrorist": False,
-                    "is_terrorist_reason": "ERROR",
-                    "is_extremist": False,
-                    "is_extremist_reason": "ERROR",
-                    "is_child_exploitation": False,
-                    "is_child_exploitation_reason": "ERROR",
-                    "is_hate_speech": False,
-                    "is_hate_speech_reason": "ERROR",
-                    "is_spam": False,
-                    "is_spam_reason": "ERROR",
-                    "is_racist_or_racial_slur": False,
-                    "is_racist_or_racial_slur_reason": "ERROR"
-                }
-
-            # 2. Text Transformer
-            keywords = self.summarize_text(post_text, vlm_output)
-            
-            # 3. Classify
-            scores = self.classify_to_scores(keywords)
-            
-            # 4. Binary Tags
-            binary_tags = self.apply_policy(scores)
-            
-            result_row = {
-                'post_id': post_id,
-                'post_text': post_text,
-                'keywords': keywords, 
-                **vlm_output,
-                **scores,
-                **binary_tags
-            }
-            results.append(result_row)
-            
-            if i % 10 == 0:
-                print(f"Processed {i+1}/{len(df)} posts...")
-                
-        return pd.DataFrame(results)
+        # Plain column lists instead of df.iterrows(), which boxes every row into a Series
+        post_ids = df['id'].tolist()
+        texts = df['text'].tolist() if 'text' in df else [''] * len(df)
+        img_paths = df['img_abs_path'].tolist()
+
+        vlm_outputs, keywords_list = self._loop.run_until_complete(
+            self._process_batch_async(texts, img_paths)
+        )
+
+        # 3. Classify
+        scores = self.classify_to_scores(keywords_list)
+
+        # 4. Binary Tags
+        binary_tags = self.apply_policy(scores)
+
+        posts = pd.DataFrame({
+            'post_id': post_ids,
+            'post_text': texts,
+            'keywords': keywords_list,
+        })
+        return pd.concat([posts, pd.DataFrame(vlm_outputs), scores, binary_tags], axis=1)
@@ -1,35 +1,136 @@
 import os
+import uuid
+import numpy as np
 import pandas as pd
-from typing import Dict
+import pyarrow as pa
+import pyarrow.dataset as ds
+from typing import List, Optional
 import config
 
+
+def _widen_type(a: pa.DataType, b: pa.DataType) -> pa.DataType:
+    """Narrowest type both a and b cast to: numeric promotion where Arrow allows it, else text."""
+    if a == b or pa.types.is_null(b):
+        return a
+    if pa.types.is_null(a):
+        return b
+    try:
+        unified = pa.unify_schemas([pa.schema([("c", a)]), pa.schema([("c", b)])], promote_options="permissive")
+        return unified.field("c").type
+    except pa.ArrowException:
+        return pa.string()
+
+
+def _conform(table: pa.Table, schema: pa.Schema) -> pa.Table:
+    """Casts table to schema, filling columns it lacks with nulls."""
+    columns = [
+        table[f.name].cast(f.type) if f.name in table.column_names else pa.nulls(len(table), f.type)
+        for f in schema
+    ]
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
 class FeatureStore:
     """Manages Offline and Online stores."""
     
     def __init__(self):
         self.online_store = {}
+        # Column order of the feature vectors held in the online store
+        self.feature_cols: List[str] = []
         self.offline_file = config.OFFLINE_FILE
+        # Offline writer state, set up lazily on the first write_offline() and reused after
+        self._offline_schema: Optional[pa.Schema] = None
+        self._offline_write_options = None
 
-    def write_offline(self, df: pd.DataFrame):
-        """Step 6: Offline Storage (Append to CSV)."""
-        if os.path.exists(self.offline_file):
-            df.to_csv(self.offline_file, mode='a', header=False, index=False)
+    def _to_arrow(self, df: pd.DataFrame) -> pa.Table:
+        """
+        Converts a batch to Arrow under the offline schema. A batch that doesn't fit
+        widens the schema, and the parts already written are re-cast to match, so
+        every part in the dataset keeps one schema.
+        """
+        schema = self._offline_schema
+        # from_pandas with a schema silently drops columns the schema lacks, so only
+        # reuse it when the batch has exactly the same columns
+        if schema is not None and set(df.columns) == set(schema.names):
+            try:
+                return pa.Table.from_pandas(df, schema=schema, preserve_index=False)
+            except (KeyError, pa.ArrowException):
+                pass  # Types changed between batches; widen the schema below
+
+        try:
+            table = pa.Table.from_pandas(df, preserve_index=False)
+        except pa.ArrowException:
+            # Model output can mix types within a column (e.g. True vs "true"); store those as text
+            text_cols = {c: str for c in df.columns if df[c].dtype == object and c != 'keywords'}
+            table = pa.Table.from_pandas(df.astype(text_cols), preserve_index=False)
+
+        if schema is None:
+            # An all-null column has no type yet; store it as text so later batches fit
+            self._offline_schema = pa.schema(
+                [f.with_type(pa.string()) if pa.types.is_null(f.type) else f for f in table.schema],
+                metadata=table.schema.metadata,
+            )
         else:
-            df.to_csv(self.offline_file, mode='w', header=True, index=False)
+            fields = {f.name: f.type for f in schema}
+            for f in table.schema:
+                fields[f.name] = _widen_type(fields[f.name], f.type) if f.name in fields else f.type
+            widened = pa.schema(list(fields.items()))
+            if not widened.equals(schema, check_metadata=False):
+                self._offline_schema = widened
+                self._rewrite_offline()
+        return _conform(table, self._offline_schema)
+
+    def _rewrite_offline(self):
+        """Re-casts the parts already written to the current (widened) offline schema."""
+        if not os.path.isdir(self.offline_file):
+            return
+        dataset = ds.dataset(self.offline_file, format="parquet")
+        old_parts = dataset.files
+        if not old_parts:
+            return
+        self._write_part(_conform(dataset.to_table(), self._offline_schema))
+        for path in old_parts:
+            os.remove(path)
+
+    def _write_part(self, table: pa.Table):
+        """Appends one Parquet part to the offline dataset directory."""
+        if self._offline_write_options is None:
+            self._offline_write_options = ds.ParquetFileFormat().make_write_options(compression="zstd")
+        ds.write_dataset(
+            table,
+            self.offline_file,
+            format="parquet",
+            file_options=self._offline_write_options,
+            basename_template=f"part-{uuid.uuid4().hex}-{{i}}.parquet",
+            existing_data_behavior="overwrite_or_ignore",
+        )
+
+    def write_offline(self, df: pd.DataFrame):
+        """Step 6: Offline Storage (Append a Parquet part to the dataset directory)."""
+        self._write_part(self._to_arrow(df))
         print(f"Written {len(df)} records to Offline Store ({self.offline_file})")
 
     def write_online(self, df: pd.DataFrame):
         """Step 7: Online Storage (Update Mock Redis)."""
         print("Updating Online Store (Mock Redis)...")
         feature_cols = [c for c in df.columns if c.startswith("Is_")]
-        
-        for _, row in df.iterrows():
-            post_id = str(row['post_id'])
-            features = row[feature_cols].to_dict()
-            self.online_store[post_id] = features
+        # Stored vectors are read back by position, so every batch must share one column order
+        if not self.feature_cols:
+            self.feature_cols = feature_cols
+        elif set(feature_cols) == set(self.feature_cols):
+            feature_cols = self.feature_cols
+        else:
+            raise ValueError(
+                f"Online feature columns changed between batches: {self.feature_cols} -> {feature_cols}"
+            )
+
+        # One array for the whole batch; each post maps to a ready-to-predict row of it,
+        # so serving skips dict -> list -> array conversion
+        features = np.ascontiguousarray(df[feature_cols].to_numpy(dtype=np.int8))
+        self.online_store.update(zip(df['post_id'].astype(str), features))
         
         print(f"Online Store now has {len(self.online_store)} keys.")
 
-    def get_online_features(self, post_id: str) -> Dict[str, int]:
+    def get_online_features(self, post_id: str) -> Optional[np.ndarray]:
         """Step 8: Feature Retrieval."""
         return self.online_store.get(str(post_id), None)
@@ -1,4 +1,5 @@
 import os
+import shutil
 import config
 from feature_factory import FeatureFactory
 from feature_store import FeatureStore
@@ -11,7 +12,7 @@ def run_pipeline():
     
     # Clean slate for offline file
     if os.path.exists(config.OFFLINE_FILE):
-        os.remove(config.OFFLINE_FILE)
+        shutil.rmtree(config.OFFLINE_FILE)
         print(f"Deleted old feature file: {config.OFFLINE_FILE}")
     
     # ---------------------------------------------------------
@@ -35,6 +36,7 @@ def run_pipeline():
         engine.train_model()
     else:
         print("Error: No training data found.")
+        factory.close()
         return
 
     # ---------------------------------------------------------
@@ -64,5 +66,7 @@ def run_pipeline():
             decision = engine.serve_prediction(pid)
             print(f"Post {pid}: Action={decision['action']} (Score={decision.get('score')})")
 
+    factory.close()
+
 if __name__ == "__main__":
     run_pipeline()
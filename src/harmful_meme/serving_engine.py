@@ -1,7 +1,8 @@
 import os
-import random
+import joblib
 import numpy as np
 import pandas as pd
+import pyarrow.dataset as ds
 from typing import Dict, Any
 from sklearn.linear_model import LogisticRegression
 import config
@@ -13,6 +14,16 @@ class ServingEngine:
     def __init__(self, feature_store: FeatureStore):
         self.feature_store = feature_store
         self.model = None
+        # Warm start: reuse the saved model unless the offline data changed since it was trained
+        if self._model_is_fresh():
+            self.model = joblib.load(config.MODEL_FILE)
+            print(f"Loaded trained model from {config.MODEL_FILE}")
+
+    def _model_is_fresh(self) -> bool:
+        """True when the saved model is at least as new as the offline training data."""
+        if not (os.path.exists(config.MODEL_FILE) and os.path.exists(config.OFFLINE_FILE)):
+            return False
+        return os.path.getmtime(config.MODEL_FILE) >= os.path.getmtime(config.OFFLINE_FILE)
 
     def train_model(self):
         """Step 9: Train simple model on Offline Data."""
@@ -21,25 +32,27 @@ class ServingEngine:
             print("No training data found.")
             return
 
-        df = pd.read_csv(config.OFFLINE_FILE)
-        
-        # X: Binary Tags
-        feature_cols = [c for c in df.columns if c.startswith("Is_")]
+        if self.model is not None and self._model_is_fresh():
+            print("Saved model is up to date with the offline data; skipping training.")
+            return
+
+        # X: Binary Tags (Parquet is columnar, so only these columns are read)
+        schema = ds.dataset(config.OFFLINE_FILE, format="parquet").schema
+        feature_cols = [c for c in schema.names if c.startswith("Is_")]
+        df = pd.read_parquet(config.OFFLINE_FILE, columns=feature_cols)
         X = df[feature_cols]
         
         # Y: Synthetic Label (0=Block/Bad, 1=Display/Good)
-        y = []
-        for _, row in df.iterrows():
-            if row.get('Is_Harmful_Content', 0) == 1:
-                label = 0 if random.random() > 0.1 else 1
-            else:
-                label = 1 if random.random() > 0.1 else 0
-            y.append(label)
+        # Harmful rows are labelled 0 with 90% probability, the rest 1 with 90% probability
+        harmful = df['Is_Harmful_Content'].to_numpy() if 'Is_Harmful_Content' in df else np.zeros(len(df))
+        r = np.random.rand(len(df))
+        y = np.where(harmful == 1, (r <= 0.1).astype(int), (r > 0.1).astype(int))
         
         self.model = LogisticRegression()
         try:
              self.model.fit(X, y)
              print(f"Model Trained successfully on {len(df)} rows.")
+             joblib.dump(self.model, config.MODEL_FILE)
         except Exception as e:
              print(f"Model training failed (likely not enough class variance): {e}")
 
@@ -47,16 +60,17 @@ class ServingEngine:
         """Step 10: Enforcement Endpoint."""
         # 1. Fetch
         features = self.feature_store.get_online_features(post_id)
-        if not features:
+        if features is None:
             return {"post_id": post_id, "action": "ERROR_NOT_FOUND"}
 
         # 2. Predict
         if self.model:
-            feature_vector = [list(features.values())] 
-            prob = self.model.predict_proba(feature_vector)[0][1] 
+            prob = self.model.predict_proba(features.reshape(1, -1))[0][1]
         else:
             # Fallback
-            prob = 0.0 if features.get('Is_Harmful_Content') == 1 else 1.0
+            feature_cols = self.feature_store.feature_cols
+            harmful = 'Is_Harmful_Content' in feature_cols and features[feature_cols.index('Is_Harmful_Content')] == 1
+            prob = 0.0 if harmful else 1.0
 
         # 3. Decide
         action = "DISPLAY"
@@ -1,20 +1,250 @@
+import itertools
+import multiprocessing
 import os
-import json
+import pickle
+import re
+import time
+import numpy as np
+import orjson
+import pyarrow as pa
+import pyarrow.compute as pc
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Dict, Iterator, List, Optional, Set, Tuple
 import config
 
+# (path, st_dev, st_ino) of an image found on disk
+ImageEntry = Tuple[str, int, int]
+
+# Directory scans are I/O latency bound, so threads overlap them well
+SCAN_WORKERS = 16
+# Directories with more subdirectories than this hand them to the pool;
+# smaller subtrees are walked inline by the worker that found them
+PARALLEL_SUBDIR_THRESHOLD = 4
+# Only "img" is needed from each JSONL line, so it is located by byte search
+_IMG_KEYS = (b'"img":"', b'"img": "')
+# Anchored, case-insensitive extension test; no lowercased copy of each name is built
+_IS_IMAGE = re.compile(r'\.(?:png|jpe?g)\Z', re.IGNORECASE).search
+# Like os.fwalk: where supported, subdirectories are opened relative to their parent's fd
+# (openat + fdopendir) so deep paths are not resolved from the top at every level
+_USE_DIR_FDS = os.scandir in os.supports_fd and os.open in os.supports_dir_fd
+_DIR_OPEN_FLAGS = os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)
+# JSONL is read in large blocks and split in bulk rather than line by line
+READ_CHUNK_SIZE = 4 * 1024 * 1024
+# JSONL files larger than this are parsed by one process per core, each over its own byte range
+PARALLEL_PARSE_MIN_BYTES = 64 * 1024 * 1024
+# Coarsest directory mtime resolution to guard against (whole seconds on many
+# filesystems, two on FAT): a change inside one tick may leave the mtime unchanged
+MTIME_GRANULARITY_NS = 2 * 1000 * 1000 * 1000
+
+
+def _extract_img(line: bytes) -> str:
+    """
+    Pulls the "img" value out of a JSONL line without decoding the rest of it.
+    Falls back to orjson when the fast path can't be trusted (other spacing, escapes,
+    or a brace before the key, which may put the match inside a nested object).
+    """
+    for key in _IMG_KEYS:
+        start = line.find(key)
+        if start >= 0:
+            # Only the record's own opening brace may precede a top-level key
+            if line.count(b'{', 0, start) != 1:
+                break
+            start += len(key)
+            end = line.find(b'"', start)
+            if end >= 0 and line.find(b'\\', start, end) < 0:
+                return line[start:end].decode()
+            break
+    return orjson.loads(line)['img']
+
+
+def _iter_lines(path: str, start: int = 0, end: Optional[int] = None) -> Iterator[bytes]:
+    """
+    Yields the non-empty lines that begin inside the byte range [start, end) of a
+    file, reading it in READ_CHUNK_SIZE blocks. Adjacent ranges split a file exactly.
+    """
+    with open(path, 'rb', buffering=0) as f:
+        # Read from one byte early: everything up to the first newline belongs to
+        # the previous range (an empty piece if a line starts exactly at start)
+        skip_partial = start > 0
+        line_start = start - 1 if skip_partial else 0
+        f.seek(line_start)
+        remainder = b''
+        while True:
+            chunk = f.read(READ_CHUNK_SIZE)
+            if not chunk:
+                break
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                if skip_partial:
+                    skip_partial = False
+                elif end is not None and line_start >= end:
+                    return
+                elif line:
+                    yield line
+                line_start += len(line) + 1
+        if remainder and not skip_partial and (end is None or line_start < end):
+            yield remainder
+
+
+def _parse_range(path: str, start: int, end: int) -> List[str]:
+    """Worker: image paths referenced by the lines starting in [start, end)."""
+    return [_extract_img(line) for line in _iter_lines(path, start, end)]
+
+
+def _read_referenced_images(path: str) -> Set[str]:
+    """Image paths referenced by a JSONL file, parsed in parallel when it is large."""
+    size = os.path.getsize(path)
+    workers = os.cpu_count() or 1
+    if size < PARALLEL_PARSE_MIN_BYTES or workers == 1:
+        shards = [_parse_range(path, 0, size)]
+    else:
+        bounds = [size * i // workers for i in range(workers + 1)]
+        # fork skips re-importing this module (and config) in every worker where available
+        method = 'fork' if 'fork' in multiprocessing.get_all_start_methods() else None
+        with multiprocessing.get_context(method).Pool(workers) as pool:
+            shards = pool.starmap(_parse_range, [(path, bounds[i], bounds[i + 1]) for i in range(workers)])
+    # Shards are plain lists, so every path is hashed into a set exactly once, here
+    return set(itertools.chain.from_iterable(shards))
+
+
+def _scan_dir(path: str) -> Tuple[List[ImageEntry], List[str], List[Tuple[str, int]]]:
+    """
+    Scans a directory and its small subtrees with os.scandir, skipping hidden
+    and unreadable directories. Returns ((path, st_dev, st_ino) of each image found,
+    subdirectories to scan in parallel, (directory, mtime_ns) of every directory scanned).
+    """
+    images = []
+    fanout = []
+    dir_mtimes = []
+    is_image = _IS_IMAGE
+    # (path, fd) pairs; fd is None when the directory still has to be opened by path
+    stack = [(path, None)]
+    try:
+        while stack:
+            dir_path, fd = stack.pop()
+            subdirs = []
+            try:
+                if fd is None and _USE_DIR_FDS:
+                    fd = os.open(dir_path, _DIR_OPEN_FLAGS)
+                # Taken before listing, so a change made mid-scan invalidates the cached index
+                dir_stat = os.stat(dir_path if fd is None else fd)
+                dir_mtimes.append((dir_path, dir_stat.st_mtime_ns))
+                # Hoisted out of the per-entry loop: a plain concat replaces os.path.join,
+                # and the bound methods skip an attribute lookup per entry
+                prefix = os.path.join(dir_path, '')
+                dev = dir_stat.st_dev
+                add_image = images.append
+                add_subdir = subdirs.append
+                with os.scandir(dir_path if fd is None else fd) as it:
+                    for entry in it:
+                        name = entry.name
+                        # DirEntry caches d_type; follow_symlinks=False keeps symlinks (and
+                        # their targets) from costing a stat(). Never call entry.stat() here.
+                        if entry.is_dir(follow_symlinks=False):
+                            if not name.startswith('.'):
+                                add_subdir(name)
+                            continue
+                        # Extension filter first: only matching names pay for building a path
+                        if is_image(name) is None:
+                            continue
+                        # inode() comes from the dirent; the device is shared by the whole directory
+                        add_image((prefix + name, dev, entry.inode()))
+
+                if len(subdirs) > PARALLEL_SUBDIR_THRESHOLD:
+                    fanout.extend(os.path.join(dir_path, name) for name in subdirs)
+                elif fd is None:
+                    stack.extend((os.path.join(dir_path, name), None) for name in subdirs)
+                else:
+                    for name in subdirs:
+                        try:
+                            child_fd = os.open(name, _DIR_OPEN_FLAGS, dir_fd=fd)
+                        except OSError:
+                            child_fd = None  # Reopened by path when popped, which reports the error
+                        stack.append((os.path.join(dir_path, name), child_fd))
+            except OSError as e:
+                # Like os.walk, an unreadable or vanished directory is skipped rather than
+                # fatal. Its impossible mtime keeps the cached index from ever validating.
+                print(f"Warning: skipping {dir_path} ({e.strerror})")
+                dir_mtimes.append((dir_path, -1))
+            finally:
+                if fd is not None:
+                    os.close(fd)
+    finally:
+        for _, fd in stack:
+            if fd is not None:
+                os.close(fd)
+    return images, fanout, dir_mtimes
+
+
+def _walk_images(top: str, dir_mtimes: Dict[str, int]) -> Iterator[ImageEntry]:
+    """
+    Yields (path, st_dev, st_ino) for every image under top as directories finish
+    scanning concurrently.
+    Records the mtime of each scanned directory into dir_mtimes.
+    """
+    with ThreadPoolExecutor(max_workers=SCAN_WORKERS) as pool:
+        pending = {pool.submit(_scan_dir, top)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                found, subdirs, mtimes = future.result()
+                pending.update(pool.submit(_scan_dir, d) for d in subdirs)
+                dir_mtimes.update(mtimes)
+                yield from found
+
+
+def _load_fs_index(top: str) -> Optional[List[ImageEntry]]:
+    """
+    Returns the cached image entries for top if no scanned directory changed since.
+    Adding, removing or renaming an entry updates its directory's mtime, so one
+    stat() per directory stands in for re-listing the whole tree.
+    """
+    try:
+        with open(config.FS_INDEX_CACHE, 'rb') as f:
+            index = pickle.load(f)
+        if index['top'] != top:
+            return None
+        for dir_path, mtime_ns in index['dir_mtimes'].items():
+            if os.stat(dir_path).st_mtime_ns != mtime_ns:
+                return None
+    except (OSError, pickle.UnpicklingError, EOFError, KeyError):
+        return None
+    return index['entries']
+
+
+def _save_fs_index(top: str, dir_mtimes: Dict[str, int], images: List[ImageEntry], scan_start_ns: int):
+    """Persists a full scan for _load_fs_index; failures only cost the next run a rescan."""
+    # Like racy git: a directory modified within one mtime tick of the scan may have changed
+    # again after it was listed without its mtime moving. Such directories are saved with an
+    # mtime that never validates, so the next run rescans instead of trusting them.
+    racy_after = scan_start_ns - MTIME_GRANULARITY_NS
+    dir_mtimes = {d: (m if m < racy_after else -1) for d, m in dir_mtimes.items()}
+    tmp_path = f"{config.FS_INDEX_CACHE}.tmp"
+    try:
+        os.makedirs(os.path.dirname(config.FS_INDEX_CACHE), exist_ok=True)
+        with open(tmp_path, 'wb') as f:
+            pickle.dump({'top': top, 'dir_mtimes': dir_mtimes, 'entries': images}, f,
+                        protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp_path, config.FS_INDEX_CACHE)
+    except OSError as e:
+        print(f"Warning: could not save filesystem index ({e})")
+
+
+def _first_sorted(paths: pa.Array, k: int = 5) -> List[str]:
+    """The k smallest paths in order, via top-k selection rather than a full sort."""
+    return paths.take(pc.select_k_unstable(paths, k=k, sort_keys=[('path', 'ascending')])).to_pylist()
+
+
 def verify_data():
     base_dir = config.BASE_DATA_DIR
     jsonl_path = os.path.join(base_dir, config.JSONL_FILE)
     img_base_dir = base_dir 
     
     # 1. Gather all referenced images from JSONL
-    referenced_images = set()
     print(f"Reading {jsonl_path}...")
     try:
-        with open(jsonl_path, 'r') as f:
-            for line in f:
-                entry = json.loads(line)
-                referenced_images.add(entry['img'])
+        referenced_images = _read_referenced_images(jsonl_path)
     except FileNotFoundError:
         print(f"Error: JSONL file not found at {jsonl_path}")
         return
@@ -22,41 +252,67 @@ def verify_data():
     print(f"Total entries in JSONL: {len(referenced_images)}")
 
     # 2. Gather all actual files in filesystem
-    existing_files = set()
     print(f"Scanning directory {img_base_dir}...")
     
     # Traverse recursively provided the structure usually has 'img' inside
     # But since config says JSONL has relative paths like "img/01234.png"
     # we should scan relative to base_dir
     
-    for root, dirs, files in os.walk(img_base_dir):
-        for file in files:
-            if file.lower().endswith(('.png', '.jpg', '.jpeg')):
-                # Create relative path from base_dir to match JSONL format
-                abs_path = os.path.join(root, file)
-                rel_path = os.path.relpath(abs_path, base_dir)
-                existing_files.add(rel_path)
+    images = _load_fs_index(img_base_dir)
+    if images is None:
+        dir_mtimes = {}
+        scan_start_ns = time.time_ns()
+        images = list(_walk_images(img_base_dir, dir_mtimes))
+        _save_fs_index(img_base_dir, dir_mtimes, images, scan_start_ns)
+    else:
+        print("No directory changed since the last scan; using the cached index.")
+
+    # Create relative path from base_dir to match JSONL format. Every scanned
+    # path starts with this prefix, so slicing replaces os.path.relpath
+    prefix_len = len(os.path.join(base_dir, ''))
+    existing_files = [abs_path[prefix_len:] for abs_path, _, _ in images]
+    if os.sep != '/':
+        existing_files = [rel_path.replace(os.sep, '/') for rel_path in existing_files]
 
     print(f"Total image files found: {len(existing_files)}")
 
-    # 3. Compare
-    missing_from_fs = referenced_images - existing_files
-    extra_in_fs = existing_files - referenced_images
-    
+    # 3. Compare as Arrow string arrays: C-level hashing over contiguous buffers
+    # instead of Python set arithmetic on individual str objects
+    referenced = pa.array(list(referenced_images), type=pa.string())
+    existing = pa.table({
+        'path': pa.array(existing_files, type=pa.string()),
+        'dev': pa.array([dev for _, dev, _ in images], type=pa.uint64()),
+        'ino': pa.array([ino for _, _, ino in images], type=pa.uint64()),
+    })
+    # One hash table over the disk paths answers both directions: a null index is a
+    # missing image, and the matched indices mark which disk rows are referenced
+    match = pc.index_in(referenced, value_set=existing['path'])
+    missing_from_fs = referenced.filter(pc.is_null(match))
+    is_referenced = np.zeros(existing.num_rows, dtype=bool)
+    is_referenced[pc.drop_null(match).to_numpy()] = True
+    is_referenced = pa.array(is_referenced)
+
+    # Hardlinks are one file under several names: a name only counts as extra if no
+    # name of the same (dev, ino) is referenced, and each such file is counted once
+    referenced_files = existing.filter(is_referenced).select(['dev', 'ino'])
+    extra_files = existing.filter(pc.invert(is_referenced))
+    extra_files = extra_files.join(referenced_files, keys=['dev', 'ino'], join_type='left anti')
+    extra_in_fs = extra_files.group_by(['dev', 'ino']).aggregate([('path', 'min')])['path_min']
+
     print("\n" + "="*40)
     print("RESULTS")
     print("="*40)
     print(f"Images in JSONL but MISSING from disk: {len(missing_from_fs)}")
-    if missing_from_fs:
+    if len(missing_from_fs):
         print("First 5 missing examples:")
-        for i, img in enumerate(list(missing_from_fs)[:5]):
+        for img in _first_sorted(missing_from_fs):
             print(f" - {img}")
             
     print("-" * 20)
     print(f"Images on disk but NOT in this JSONL: {len(extra_in_fs)}")
-    if extra_in_fs:
+    if len(extra_in_fs):
         print("First 5 extra examples:")
-        for i, img in enumerate(list(extra_in_fs)[:5]):
+        for img in _first_sorted(extra_in_fs):
             print(f" - {img}")
 
 if __name__ == "__main__":